@@ -1,13 +1,41 @@
-from fastapi import FastAPI, HTTPException, Header, status
+from fastapi import Depends, FastAPI, HTTPException, Header, Response, status
+from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers
 from pydantic import BaseModel
-from typing import Optional, Dict
+from typing import Optional, Dict, Awaitable, Callable, Protocol
+from collections import OrderedDict
+from dataclasses import dataclass
+from enum import IntEnum
+from contextlib import asynccontextmanager, suppress
 import uuid
 import asyncio
-from datetime import datetime, timedelta
-import threading
+import hashlib
+import orjson
+from datetime import datetime
+import os
+import struct
 import time
 
-app = FastAPI()
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # only needed for RedisIdempotencyStore
+    aioredis = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Run the expired-key sweep, or hold the Redis connections, for the lifetime of the app"""
+    if isinstance(idempotency_store, RedisIdempotencyStore):
+        # Redis expires keys on its own
+        yield
+        await idempotency_store.close()
+        return
+    cleanup_task = asyncio.create_task(idempotency_store.run_cleanup())
+    yield
+    cleanup_task.cancel()
+    with suppress(asyncio.CancelledError):
+        await cleanup_task
+
+app = FastAPI(lifespan=lifespan)
 
 # Models
 class PaymentRequest(BaseModel):
@@ -23,79 +51,404 @@ class PaymentResponse(BaseModel):
     currency: str
     timestamp: datetime
 
+def request_fingerprint(method: str, path: str, body: bytes) -> bytes:
+    """Hash the request target and raw body so replays can be compared with a single bytes compare"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{method} {path}\n".encode())
+    digest.update(body)
+    return digest.digest()
+
+class Status(IntEnum):
+    """Processing state of an idempotency key"""
+    PROCESSING = 0
+    COMPLETED = 1
+
+@dataclass(slots=True)
+class StoreEntry:
+    """Stored state of one idempotency key"""
+    fingerprint: bytes
+    token: bytes = b""  # claim that owns the key; only it may put or release
+    expires_at: float = 0.0  # time.monotonic() deadline, in-memory store only
+    status: Status = Status.PROCESSING
+    status_code: Optional[int] = None
+    headers: Optional[Dict[str, str]] = None
+    response_body: Optional[bytes] = None  # serialized once for cheap replays
+
 # Storage for idempotency keys
-class IdempotencyStore:
-    def __init__(self):
-        self.store: Dict[str, dict] = {}
-        self.locks: Dict[str, threading.Lock] = {}
-        self.expiry_time = timedelta(hours=24)
-        
-    def get_lock(self, key: str) -> threading.Lock:
-        """Get or create a lock for a specific idempotency key"""
-        if key not in self.locks:
-            self.locks[key] = threading.Lock()
-        return self.locks[key]
-    
-    def store_request(self, key: str, request: PaymentRequest):
-        """Store a new request with processing status"""
-        with self.get_lock(key):
-            self.store[key] = {
-                'request': request,
-                'response': None,
-                'status': 'processing',  # processing, completed, error
-                'created_at': datetime.now(),
-                'expires_at': datetime.now() + self.expiry_time
-            }
-    
-    def store_response(self, key: str, response: PaymentResponse):
-        """Store the response for a completed request"""
-        with self.get_lock(key):
-            if key in self.store:
-                self.store[key]['response'] = response
-                self.store[key]['status'] = 'completed'
-    
-    def store_error(self, key: str, error: dict):
-        """Store an error response"""
-        with self.get_lock(key):
-            if key in self.store:
-                self.store[key]['response'] = error
-                self.store[key]['status'] = 'error'
-    
-    def get(self, key: str) -> Optional[dict]:
+class IdempotencyStore(Protocol):
+    """Backend holding idempotency keys and the responses stored for them"""
+    
+    async def acquire_lease(self, key: str, fingerprint: bytes, token: bytes) -> Optional[StoreEntry]:
+        """Atomically claim a key for processing under a unique 16 byte token.
+
+        Returns None if the caller now owns the key and must put() its
+        response, otherwise the entry already stored for the key.
+        """
+        ...
+    
+    async def put(self, key: str, entry: StoreEntry) -> None:
+        """Store the final response for a key still claimed by entry.token and wake its waiters"""
+        ...
+    
+    async def release(self, key: str, token: bytes) -> None:
+        """Give up a key still claimed by token without a response so it can be retried"""
+        ...
+    
+    async def get(self, key: str) -> Optional[StoreEntry]:
         """Get stored data for a key"""
-        # Clean expired keys first
-        self.clean_expired()
+        ...
+    
+    async def wait(self, key: str) -> Optional[StoreEntry]:
+        """Wait for a key being processed elsewhere to get its response"""
+        ...
+
+class InMemoryIdempotencyStore:
+    """Idempotency store local to a single process"""
+    
+    def __init__(self, num_shards: int = 32, max_entries: int = 100_000):
+        # Keys are partitioned across shards, each with its own dict and lock,
+        # so unrelated keys never contend and no per-key lock map is needed.
+        # Entries are kept in insertion order; with a fixed TTL that is also
+        # expiry order, so the oldest entry of a shard is always at the front.
+        self.shards = [
+            {'store': OrderedDict(), 'lock': asyncio.Lock()}
+            for _ in range(num_shards)
+        ]
+        # Cap memory no matter how many distinct keys clients send
+        self.max_shard_entries = -(-max_entries // num_shards)
+        # Seconds; deadlines use time.monotonic() since they are never shown
+        self.expiry_time = 24 * 60 * 60.0
+        # Keys live for hours, so sweeping once a minute is plenty
+        self.cleanup_interval = 60.0
+        
+    def _shard(self, key: str) -> dict:
+        """Get the shard a key belongs to"""
+        return self.shards[hash(key) % len(self.shards)]
+    
+    def __len__(self) -> int:
+        """Number of stored keys, including expired ones not yet swept"""
+        return sum(len(shard['store']) for shard in self.shards)
+    
+    async def acquire_lease(self, key: str, fingerprint: bytes, token: bytes) -> Optional[StoreEntry]:
+        """Store a new request with processing status unless the key exists"""
+        # Fast path for keys that were already seen
+        entry = self.peek(key)
+        if entry is not None:
+            return entry
         
-        with self.get_lock(key):
-            return self.store.get(key)
+        shard = self._shard(key)
+        async with shard['lock']:
+            entry = self.peek(key)
+            if entry is not None:
+                return entry
+            store = shard['store']
+            store.pop(key, None)
+            # Evict the oldest entries once the shard is full. In-flight
+            # entries are skipped so their waiters still get a response;
+            # there are only as many of them as requests being processed.
+            while len(store) >= self.max_shard_entries:
+                oldest_key = next(
+                    (stored_key for stored_key, stored in store.items()
+                     if stored.status is not Status.PROCESSING),
+                    None
+                )
+                if oldest_key is None:
+                    break
+                del store[oldest_key]
+            store[key] = StoreEntry(
+                fingerprint=fingerprint,
+                token=token,
+                expires_at=time.monotonic() + self.expiry_time
+            )
+            return None
+    
+    async def put(self, key: str, entry: StoreEntry) -> None:
+        """Store the response for a completed request, keeping its expiry"""
+        shard = self._shard(key)
+        async with shard['lock']:
+            stored = shard['store'].get(key)
+            # The claim may have expired and been taken by another request
+            if stored is not None and stored.token == entry.token:
+                stored.status_code = entry.status_code
+                stored.headers = entry.headers
+                stored.response_body = entry.response_body
+                stored.status = entry.status
+    
+    async def release(self, key: str, token: bytes) -> None:
+        """Remove a key that is still processing so a retry can claim it"""
+        shard = self._shard(key)
+        async with shard['lock']:
+            stored = shard['store'].get(key)
+            if (stored is not None and stored.token == token
+                    and stored.status is Status.PROCESSING):
+                del shard['store'][key]
+    
+    def peek(self, key: str) -> Optional[StoreEntry]:
+        """Get stored data for a key without taking the shard lock.
+
+        A dict read never awaits, so it is atomic on the event loop. Used as
+        the fast path for the common case of a key that was never seen.
+        """
+        entry = self._shard(key)['store'].get(key)
+        # Expired keys may linger until the next sweep
+        if entry is None or entry.expires_at < time.monotonic():
+            return None
+        return entry
+    
+    async def get(self, key: str) -> Optional[StoreEntry]:
+        """Get stored data for a key"""
+        async with self._shard(key)['lock']:
+            return self.peek(key)
+    
+    async def wait(self, key: str) -> Optional[StoreEntry]:
+        """Get the response for a key once its in-flight request finished.
+
+        Duplicates in this process already joined the running request, so
+        the entry is final, or gone if it was released, by the time this is
+        called.
+        """
+        return await self.get(key)
     
     def clean_expired(self):
-        """Remove expired keys from storage"""
-        current_time = datetime.now()
-        expired_keys = []
-        
-        for key, data in self.store.items():
-            if data['expires_at'] < current_time:
-                expired_keys.append(key)
-        
-        for key in expired_keys:
-            with self.get_lock(key):
-                if key in self.store and self.store[key]['expires_at'] < current_time:
-                    del self.store[key]
-                    if key in self.locks:
-                        del self.locks[key]
+        """Remove expired keys from storage.
+
+        Never awaits, so on a single-threaded event loop the dict
+        mutation is atomic and needs no lock.
+        """
+        current_time = time.monotonic()
+        
+        for shard in self.shards:
+            store = shard['store']
+            # Only the expired prefix is visited, not every live key
+            while store:
+                key, data = next(iter(store.items()))
+                if data.expires_at >= current_time:
+                    break
+                del store[key]
+    
+    async def run_cleanup(self):
+        """Periodically remove expired keys in the background"""
+        while True:
+            await asyncio.sleep(self.cleanup_interval)
+            # Nothing to do, let the CPU idle
+            if not any(shard['store'] for shard in self.shards):
+                continue
+            self.clean_expired()
+
+class RedisIdempotencyStore:
+    """Idempotency store shared by all workers through Redis.
+
+    The first request claims a key with SET NX and a short lease, which is
+    extended to the full expiry once its response is stored. A worker that
+    crashes mid-request therefore only holds the key for the lease time.
+    Workers waiting on a key another worker is processing are woken through
+    a pub/sub channel.
+
+    Every claim carries a token at the start of the stored value. Storing a
+    response or releasing the key is a compare-and-set on that token, so a
+    worker whose lease ran out can't touch a key another worker claimed since.
+    """
+    
+    # token, fingerprint, status, status code, headers length; the JSON
+    # encoded headers and the response body follow
+    _header = struct.Struct("!16s16sBHI")
+    
+    # KEYS: entry, channel; ARGV: token, value, expiry seconds
+    _put_script = """
+local current = redis.call('GET', KEYS[1])
+if not current or string.sub(current, 1, 16) ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+redis.call('PUBLISH', KEYS[2], '')
+return 1
+"""
+    
+    # KEYS: entry, channel; ARGV: token. Byte 33 is the status, and only
+    # keys still processing are released.
+    _release_script = """
+local current = redis.call('GET', KEYS[1])
+if not current or string.sub(current, 1, 16) ~= ARGV[1]
+        or string.byte(current, 33) ~= 0 then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('PUBLISH', KEYS[2], '')
+return 1
+"""
+    
+    def __init__(self, client: "aioredis.Redis", prefix: str = "idempotency:",
+                 expiry_time: int = 24 * 60 * 60, lease_time: float = 60.0,
+                 wait_timeout: float = 30.0):
+        self.client = client
+        self.prefix = prefix
+        self.expiry_time = expiry_time
+        # Seconds a claimed key stays reserved without a response; must
+        # exceed the longest time a payment takes to process
+        self.lease_time = lease_time
+        # Longest a duplicate waits for another worker before giving up
+        self.wait_timeout = wait_timeout
+    
+    @classmethod
+    def from_url(cls, url: str, **kwargs) -> "RedisIdempotencyStore":
+        """Create a store connected to the Redis server at url"""
+        if aioredis is None:
+            raise RuntimeError("RedisIdempotencyStore requires the redis package")
+        return cls(aioredis.from_url(url), **kwargs)
+    
+    async def close(self) -> None:
+        """Close the connections to Redis"""
+        await self.client.aclose()
+    
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}{key}"
+    
+    def _channel(self, key: str) -> str:
+        return f"{self.prefix}done:{key}"
+    
+    def _dump(self, entry: StoreEntry) -> bytes:
+        headers = orjson.dumps(entry.headers) if entry.headers else b""
+        header = self._header.pack(
+            entry.token, entry.fingerprint, entry.status, entry.status_code or 0, len(headers)
+        )
+        return header + headers + (entry.response_body or b"")
+    
+    def _load(self, value: bytes) -> StoreEntry:
+        token, fingerprint, entry_status, status_code, headers_length = self._header.unpack_from(value)
+        body_start = self._header.size + headers_length
+        headers = value[self._header.size:body_start]
+        return StoreEntry(
+            fingerprint=fingerprint,
+            token=token,
+            status=Status(entry_status),
+            status_code=status_code or None,
+            headers=orjson.loads(headers) if headers else None,
+            response_body=value[body_start:] or None
+        )
+    
+    async def acquire_lease(self, key: str, fingerprint: bytes, token: bytes) -> Optional[StoreEntry]:
+        """Claim a key with SET NX, or return the entry another request stored"""
+        value = self._dump(StoreEntry(fingerprint=fingerprint, token=token))
+        while True:
+            if await self.client.set(self._key(key), value, nx=True, px=int(self.lease_time * 1000)):
+                return None
+            entry = await self.get(key)
+            # Retry if the key expired between SET and GET
+            if entry is not None:
+                return entry
+    
+    async def put(self, key: str, entry: StoreEntry) -> None:
+        """Store the response for a completed request and notify waiters"""
+        # Replaces the short lease with the full expiry
+        await self.client.eval(
+            self._put_script, 2, self._key(key), self._channel(key),
+            entry.token, self._dump(entry), self.expiry_time
+        )
+    
+    async def release(self, key: str, token: bytes) -> None:
+        """Delete a claimed key so a retry can claim it, and notify waiters"""
+        await self.client.eval(
+            self._release_script, 2, self._key(key), self._channel(key), token
+        )
+    
+    async def get(self, key: str) -> Optional[StoreEntry]:
+        """Get stored data for a key"""
+        value = await self.client.get(self._key(key))
+        return self._load(value) if value is not None else None
+    
+    async def wait(self, key: str) -> Optional[StoreEntry]:
+        """Wait until the worker processing a key publishes its response"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.wait_timeout
+        pubsub = self.client.pubsub()
+        await pubsub.subscribe(self._channel(key))
+        try:
+            # Subscribe before reading, so a response stored in between
+            # is either seen here or announced on the channel
+            entry = await self.get(key)
+            while entry is not None and entry.status is Status.PROCESSING:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                # Re-check at least once per lease, in case the worker
+                # holding the key crashed and its lease ran out
+                await pubsub.get_message(
+                    ignore_subscribe_messages=True,
+                    timeout=min(remaining, self.lease_time)
+                )
+                entry = await self.get(key)
+            return entry
+        finally:
+            await pubsub.unsubscribe()
+            await pubsub.aclose()
+
+class InflightRequests:
+    """Requests this process is currently running, by idempotency key"""
+    
+    def __init__(self):
+        # Tasks remove themselves when done, so nothing is left behind to leak
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._waiters: Dict[str, int] = {}
+    
+    def start(self, key: str, work: Awaitable) -> asyncio.Task:
+        """Run the first request for a key as a task duplicates can await"""
+        task = asyncio.ensure_future(work)
+        self._tasks[key] = task
+        
+        def discard(done: asyncio.Task):
+            if self._tasks.get(key) is done:
+                del self._tasks[key]
+        
+        task.add_done_callback(discard)
+        return task
+    
+    def get(self, key: str) -> Optional[asyncio.Task]:
+        """Get the task still processing the first request for a key"""
+        return self._tasks.get(key)
+    
+    async def join(self, key: str) -> None:
+        """Wait for the task processing a key, if any, to finish.
+
+        Uses asyncio.wait, which neither cancels the task when the waiter is
+        cancelled nor raises the task's error; the store tells the outcome.
+        """
+        task = self._tasks.get(key)
+        if task is None:
+            return
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            await asyncio.wait({task})
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+    
+    def waiters(self, key: str) -> int:
+        """Number of duplicates currently waiting on a key"""
+        return self._waiters.get(key, 0)
+
+# Global store instance. Set IDEMPOTENCY_REDIS_URL to share keys between
+# workers; otherwise keys only live in this process.
+if os.environ.get("IDEMPOTENCY_REDIS_URL"):
+    idempotency_store: IdempotencyStore = RedisIdempotencyStore.from_url(
+        os.environ["IDEMPOTENCY_REDIS_URL"]
+    )
+else:
+    idempotency_store = InMemoryIdempotencyStore()
+inflight_requests = InflightRequests()
 
-# Global store instance
-idempotency_store = IdempotencyStore()
+# Simulated processing time in seconds. Set to 0 when a real payment
+# backend provides its own latency.
+PROCESS_DELAY = float(os.environ.get("PAYMENT_PROCESS_DELAY", "0.1"))
 
 # Payment processing simulation
-async def process_payment(request: PaymentRequest) -> PaymentResponse:
+async def process_payment(request: PaymentRequest, delay: float = PROCESS_DELAY) -> PaymentResponse:
     """Simulate payment processing with a delay"""
     # Simulate processing time
-    await asyncio.sleep(0.1)
+    await asyncio.sleep(delay)
     
     # Generate a transaction ID
-    transaction_id = str(uuid.uuid4())
+    transaction_id = uuid.uuid4().hex
     
     # Return response
     return PaymentResponse(
@@ -106,57 +459,183 @@ async def process_payment(request: PaymentRequest) -> PaymentResponse:
         timestamp=datetime.now()
     )
 
+# Idempotency middleware
+# Router responses for unknown paths and methods, which are never stored
+ROUTING_ERRORS = {status.HTTP_404_NOT_FOUND, status.HTTP_405_METHOD_NOT_ALLOWED}
+
+class IdempotencyMiddleware:
+    """Replay stored responses for POST requests carrying an Idempotency-Key.
+
+    Runs before FastAPI parses the body, so a replay skips request
+    validation, the endpoint and response serialization entirely. Written
+    as plain ASGI so the first request for a key runs in a task of its
+    own: the client that sent it going away does not cancel the work its
+    duplicates are waiting on.
+    """
+    
+    def __init__(self, app, store: IdempotencyStore, inflight: InflightRequests):
+        self.app = app
+        self.store = store
+        self.inflight = inflight
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+        idempotency_key = Headers(scope=scope).get("Idempotency-Key")
+        if not idempotency_key:
+            await self.app(scope, receive, send)
+            return
+        
+        body = await self.read_body(receive)
+        if body is None:
+            # Client disconnected before sending the whole body
+            return
+        fingerprint = request_fingerprint(scope["method"], scope["path"], body)
+        
+        response = await self.respond(scope, body, idempotency_key, fingerprint)
+        await response(scope, receive, send)
+    
+    async def read_body(self, receive) -> Optional[bytes]:
+        """Receive the full request body, or None if the client went away"""
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return None
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                return b"".join(chunks)
+    
+    async def respond(self, scope, body: bytes, idempotency_key: str, fingerprint: bytes) -> Response:
+        """Process the request for a key once, or replay what is stored for it"""
+        token = uuid.uuid4().bytes
+        while True:
+            # Claim the key, or get what is stored for it if we've seen it before
+            stored_data = await self.store.acquire_lease(idempotency_key, fingerprint, token)
+            
+            if stored_data is None:
+                # Process the new request in a task duplicates can share.
+                # Shielded so the caller going away does not cancel it.
+                task = self.inflight.start(
+                    idempotency_key, self.forward(scope, body, idempotency_key, fingerprint, token)
+                )
+                return await asyncio.shield(task)
+            
+            # Verify the request is the same
+            if stored_data.fingerprint != fingerprint:
+                return JSONResponse(
+                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    content={"detail": "Idempotency key reused with different request parameters"}
+                )
+            
+            # If request is still processing, wait for the original request to finish
+            if stored_data.status is Status.PROCESSING:
+                await self.inflight.join(idempotency_key)
+                stored_data = await self.store.wait(idempotency_key)
+                if stored_data is None:
+                    # The original request failed and released the key
+                    continue
+                if stored_data.status is Status.PROCESSING:
+                    return JSONResponse(
+                        status_code=status.HTTP_409_CONFLICT,
+                        content={"detail": "A request with this idempotency key is still being processed"}
+                    )
+            
+            # Replay the stored bytes as-is, skipping response_model validation
+            # and serialization
+            return Response(
+                content=stored_data.response_body,
+                status_code=stored_data.status_code,
+                headers={**(stored_data.headers or {}), "Idempotency-Replayed": "true"}
+            )
+    
+    async def forward(self, scope, body: bytes, idempotency_key: str, fingerprint: bytes,
+                      token: bytes) -> Response:
+        """Run the first request for a key through the app and store its response"""
+        body_sent = False
+        never = asyncio.Event()
+        
+        async def receive():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            # The request is owned by this task, not by the client connection
+            await never.wait()
+        
+        start = {}
+        chunks = []
+        
+        async def send(message):
+            if message["type"] == "http.response.start":
+                start.update(message)
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+        
+        try:
+            await self.app(scope, receive, send)
+            if not start:
+                raise RuntimeError("No response returned.")
+        except BaseException:
+            # Nothing to replay, so let a retry process the key again
+            await self.store.release(idempotency_key, token)
+            raise
+        
+        # Content length is recomputed from the body when the response is built
+        headers = {
+            name.decode("latin-1"): value.decode("latin-1")
+            for name, value in start.get("headers", [])
+            if name.lower() != b"content-length"
+        }
+        response_body = b"".join(chunks)
+        if start["status"] in ROUTING_ERRORS:
+            # The request never reached an endpoint, so there is nothing to replay
+            await self.store.release(idempotency_key, token)
+            return Response(
+                content=response_body,
+                status_code=start["status"],
+                headers=headers
+            )
+        await self.store.put(idempotency_key, StoreEntry(
+            fingerprint=fingerprint,
+            token=token,
+            status=Status.COMPLETED,
+            status_code=start["status"],
+            headers=headers,
+            response_body=response_body
+        ))
+        return Response(
+            content=response_body,
+            status_code=start["status"],
+            headers=headers
+        )
+
+app.add_middleware(IdempotencyMiddleware, store=idempotency_store, inflight=inflight_requests)
+
+def payment_processor() -> Callable[[PaymentRequest], Awaitable[PaymentResponse]]:
+    """Dependency providing the function that processes a payment"""
+    return process_payment
+
 # API Endpoint
 @app.post("/payments", response_model=PaymentResponse)
 async def create_payment(
     request: PaymentRequest,
-    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    process: Callable[[PaymentRequest], Awaitable[PaymentResponse]] = Depends(payment_processor)
 ):
-    # Validate idempotency key
+    # Validate idempotency key. Deduplication itself happens in
+    # idempotency_middleware before the request reaches this handler.
     if not idempotency_key:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Idempotency-Key header is required"
         )
     
-    # Check if we've seen this key before
-    stored_data = idempotency_store.get(idempotency_key)
-    
-    if stored_data:
-        # Verify the request is the same
-        if stored_data['request'].dict() != request.dict():
-            raise HTTPException(
-                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                detail="Idempotency key reused with different request parameters"
-            )
-        
-        # If request is still processing, wait for completion
-        while stored_data['status'] == 'processing':
-            await asyncio.sleep(0.01)
-            stored_data = idempotency_store.get(idempotency_key)
-            if not stored_data:
-                break
-        
-        # Return stored response if available
-        if stored_data and stored_data['response']:
-            if isinstance(stored_data['response'], dict) and 'detail' in stored_data['response']:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail=stored_data['response']['detail']
-                )
-            return stored_data['response']
-    
-    # Store the new request
-    idempotency_store.store_request(idempotency_key, request)
-    
     try:
         # Process the payment
-        response = await process_payment(request)
-        idempotency_store.store_response(idempotency_key, response)
-        return response
+        return await process(request)
     except Exception as e:
-        # Store error
-        idempotency_store.store_error(idempotency_key, {"detail": str(e)})
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=str(e)
@@ -166,10 +645,27 @@ async def create_payment(
 if __name__ == "__main__":
     import pytest
     import requests
+    from functools import partial
     from fastapi.testclient import TestClient
     
     client = TestClient(app)
     
+    # Tests don't need the simulated processing time
+    instant_process_payment = partial(process_payment, delay=0)
+    
+    def instant_processor():
+        return instant_process_payment
+    
+    app.dependency_overrides[payment_processor] = instant_processor
+    
+    async def wait_for_waiters(key, count, timeout=5.0):
+        """Wait until count duplicates joined the request for key, failing instead of hanging"""
+        async def joined():
+            while inflight_requests.waiters(key) < count:
+                await asyncio.sleep(0)
+        
+        await asyncio.wait_for(joined(), timeout)
+    
     def test_successful_payment():
         """Test successful payment with idempotency key"""
         key = str(uuid.uuid4())
@@ -197,6 +693,7 @@ if __name__ == "__main__":
         )
         assert response2.status_code == 200
         assert response2.json()["transaction_id"] == transaction_id
+        assert response2.headers["Idempotency-Replayed"] == "true"
     
     def test_different_requests_same_key():
         """Test error when same key is used with different requests"""
@@ -232,7 +729,7 @@ if __name__ == "__main__":
     
     def test_concurrent_requests():
         """Test handling of concurrent requests with same idempotency key"""
-        import threading
+        import httpx
         
         key = str(uuid.uuid4())
         request_data = {
@@ -242,35 +739,161 @@ if __name__ == "__main__":
             "reference": "test-123"
         }
         
-        results = []
-        errors = []
+        async def run():
+            release = asyncio.Event()
+            
+            async def gated_process_payment(request):
+                # Hold the first request until every duplicate waits on it
+                await release.wait()
+                return await instant_process_payment(request)
+            
+            app.dependency_overrides[payment_processor] = lambda: gated_process_payment
+            try:
+                # All requests share one event loop, so they genuinely race
+                transport = httpx.ASGITransport(app=app)
+                async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                    requests_sent = asyncio.gather(*[
+                        client.post(
+                            "/payments",
+                            json=request_data,
+                            headers={"Idempotency-Key": key}
+                        )
+                        for _ in range(5)
+                    ])
+                    await wait_for_waiters(key, 4)
+                    release.set()
+                    return await requests_sent
+            finally:
+                app.dependency_overrides[payment_processor] = instant_processor
+        
+        responses = asyncio.run(run())
+        results = [response.json()["transaction_id"] for response in responses]
+        
+        # All responses should have the same transaction ID
+        assert all(response.status_code == 200 for response in responses), "All requests should complete successfully"
+        assert len(set(results)) == 1, "All requests should return the same transaction ID"
+        assert len(results) == 5, "All requests should complete successfully"
+    
+    def test_cancelled_request():
+        """Test that cancelling the first request doesn't cancel it for its duplicates"""
+        import httpx
+        
+        key = str(uuid.uuid4())
+        request_data = {
+            "amount": 100.0,
+            "currency": "USD",
+            "recipient": "test@example.com",
+            "reference": "test-123"
+        }
         
-        def make_request():
+        async def run():
+            entered = asyncio.Event()
+            release = asyncio.Event()
+            
+            async def gated_process_payment(request):
+                entered.set()
+                await release.wait()
+                return await instant_process_payment(request)
+            
+            app.dependency_overrides[payment_processor] = lambda: gated_process_payment
             try:
-                response = client.post(
+                transport = httpx.ASGITransport(app=app)
+                async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                    def post():
+                        return client.post(
+                            "/payments",
+                            json=request_data,
+                            headers={"Idempotency-Key": key}
+                        )
+                    
+                    # Cancel the first request while a duplicate waits on it
+                    first = asyncio.ensure_future(post())
+                    await asyncio.wait_for(entered.wait(), 5.0)
+                    duplicate = asyncio.ensure_future(post())
+                    await wait_for_waiters(key, 1)
+                    first.cancel()
+                    release.set()
+                    
+                    duplicate_response = await duplicate
+                    retry_response = await post()
+                    return first, duplicate_response, retry_response
+            finally:
+                app.dependency_overrides[payment_processor] = instant_processor
+        
+        first, duplicate_response, retry_response = asyncio.run(run())
+        
+        # The payment still completed, once, for the duplicate and the retry
+        assert first.cancelled()
+        assert duplicate_response.status_code == 200
+        assert retry_response.status_code == 200
+        assert retry_response.headers["Idempotency-Replayed"] == "true"
+        assert retry_response.json()["transaction_id"] == duplicate_response.json()["transaction_id"]
+    
+    def test_failed_request_releases_key():
+        """Test that a request failing without a response can be retried"""
+        import httpx
+        
+        key = str(uuid.uuid4())
+        request_data = {
+            "amount": 100.0,
+            "currency": "USD",
+            "recipient": "test@example.com",
+            "reference": "test-123"
+        }
+        
+        async def unavailable_processor():
+            raise RuntimeError("Payment processor unavailable")
+        
+        async def run():
+            transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                app.dependency_overrides[payment_processor] = unavailable_processor
+                try:
+                    failed_response = await client.post(
+                        "/payments",
+                        json=request_data,
+                        headers={"Idempotency-Key": key}
+                    )
+                finally:
+                    app.dependency_overrides[payment_processor] = instant_processor
+                retry_response = await client.post(
                     "/payments",
                     json=request_data,
                     headers={"Idempotency-Key": key}
                 )
-                results.append(response.json()["transaction_id"])
-            except Exception as e:
-                errors.append(str(e))
+                return failed_response, retry_response
         
-        # Create multiple threads
-        threads = []
-        for _ in range(5):
-            thread = threading.Thread(target=make_request)
-            threads.append(thread)
-            thread.start()
+        failed_response, retry_response = asyncio.run(run())
         
-        # Wait for all threads to complete
-        for thread in threads:
-            thread.join()
+        # The failure is not replayed; the retry processes the payment
+        assert failed_response.status_code == 500
+        assert retry_response.status_code == 200
+        assert "Idempotency-Replayed" not in retry_response.headers
+    
+    def test_unrouted_request_releases_key():
+        """Test that a mistyped path does not claim the key for the real endpoint"""
+        key = str(uuid.uuid4())
+        request_data = {
+            "amount": 100.0,
+            "currency": "USD",
+            "recipient": "test@example.com",
+            "reference": "test-123"
+        }
         
-        # All responses should have the same transaction ID
-        assert len(set(results)) == 1, "All requests should return the same transaction ID"
-        assert len(results) == 5, "All requests should complete successfully"
-        assert len(errors) == 0, "No requests should fail"
+        missing_response = client.post(
+            "/paymnts",
+            json=request_data,
+            headers={"Idempotency-Key": key}
+        )
+        response = client.post(
+            "/payments",
+            json=request_data,
+            headers={"Idempotency-Key": key}
+        )
+        
+        assert missing_response.status_code == 404
+        assert response.status_code == 200
+        assert "Idempotency-Replayed" not in response.headers
     
     def test_missing_idempotency_key():
         """Test error when idempotency key is missing"""
@@ -284,31 +907,250 @@ if __name__ == "__main__":
         response = client.post("/payments", json=request_data)
         assert response.status_code == 400
     
+    def test_non_json_content_type():
+        """Test that a JSON body sent with a non-JSON content type is rejected"""
+        response = client.post(
+            "/payments",
+            content=b'{"amount": 100.0, "currency": "USD", "recipient": "test@example.com", "reference": "test-123"}',
+            headers={"Idempotency-Key": str(uuid.uuid4()), "Content-Type": "text/plain"}
+        )
+        assert response.status_code == 422
+    
+    def test_openapi_schema():
+        """Test that the request body is documented through a schema reference"""
+        schema = app.openapi()
+        request_body = schema["paths"]["/payments"]["post"]["requestBody"]
+        assert request_body["content"]["application/json"]["schema"] == {
+            "$ref": "#/components/schemas/PaymentRequest"
+        }
+        assert "PaymentRequest" in schema["components"]["schemas"]
+    
     def test_key_expiration():
         """Test that keys expire after the specified time"""
         # Create a store with short expiration for testing
-        test_store = IdempotencyStore()
-        test_store.expiry_time = timedelta(seconds=1)  # 1 second expiration
+        test_store = InMemoryIdempotencyStore()
+        test_store.expiry_time = 1.0  # 1 second expiration
         
         key = str(uuid.uuid4())
-        request = PaymentRequest(
-            amount=100.0,
-            currency="USD",
-            recipient="test@example.com",
-            reference="test-123"
-        )
+        fingerprint = request_fingerprint("POST", "/payments", b'{"amount": 100.0}')
         
         # Store request
-        test_store.store_request(key, request)
+        assert asyncio.run(test_store.acquire_lease(key, fingerprint, uuid.uuid4().bytes)) is None
         
         # Verify it's stored
-        assert test_store.get(key) is not None
+        assert asyncio.run(test_store.get(key)) is not None
         
         # Wait for expiration
         time.sleep(1.1)
         
         # Verify it's expired
-        assert test_store.get(key) is None
+        assert asyncio.run(test_store.get(key)) is None
+        
+        # Verify the sweep removes it
+        test_store.clean_expired()
+        assert key not in test_store._shard(key)['store']
+    
+    def test_max_entries():
+        """Test that the oldest completed keys are evicted when the store is full"""
+        test_store = InMemoryIdempotencyStore(num_shards=1, max_entries=2)
+        fingerprint = request_fingerprint("POST", "/payments", b'{"amount": 100.0}')
+        
+        async def fill():
+            for key in ("a", "b", "c"):
+                token = uuid.uuid4().bytes
+                await test_store.acquire_lease(key, fingerprint, token)
+                await test_store.put(key, StoreEntry(
+                    fingerprint=fingerprint,
+                    token=token,
+                    status=Status.COMPLETED,
+                    status_code=200,
+                    response_body=b'{}'
+                ))
+        
+        asyncio.run(fill())
+        
+        # Only the two newest keys are kept
+        assert len(test_store) == 2
+        assert asyncio.run(test_store.get("a")) is None
+        assert asyncio.run(test_store.get("c")) is not None
+        
+        # A key still processing at the front of the shard is kept, but
+        # doesn't stop completed keys behind it from being evicted
+        test_store = InMemoryIdempotencyStore(num_shards=1, max_entries=2)
+        asyncio.run(test_store.acquire_lease("in-flight", fingerprint, uuid.uuid4().bytes))
+        
+        async def fill_behind():
+            for i in range(1000):
+                key = f"key-{i}"
+                token = uuid.uuid4().bytes
+                await test_store.acquire_lease(key, fingerprint, token)
+                await test_store.put(key, StoreEntry(
+                    fingerprint=fingerprint,
+                    token=token,
+                    status=Status.COMPLETED,
+                    status_code=200,
+                    response_body=b'{}'
+                ))
+        
+        asyncio.run(fill_behind())
+        
+        assert len(test_store) == 2
+        assert asyncio.run(test_store.get("in-flight")) is not None
+        assert asyncio.run(test_store.get("key-999")) is not None
+    
+    def test_redis_entry_round_trip():
+        """Test that Redis entries survive packing and unpacking"""
+        redis_store = RedisIdempotencyStore(client=None)
+        fingerprint = request_fingerprint("POST", "/payments", b'{"amount": 100.0}')
+        
+        completed = StoreEntry(
+            fingerprint=fingerprint,
+            token=uuid.uuid4().bytes,
+            status=Status.COMPLETED,
+            status_code=200,
+            headers={"content-type": "application/json"},
+            response_body=b'{"transaction_id": "abc"}'
+        )
+        assert redis_store._load(redis_store._dump(completed)) == completed
+        
+        processing = StoreEntry(fingerprint=fingerprint, token=uuid.uuid4().bytes)
+        assert redis_store._load(redis_store._dump(processing)) == processing
+    
+    class FakeRedis:
+        """In-process stand-in for the redis.asyncio commands the store uses"""
+        
+        def __init__(self):
+            self.values = {}
+            self.deadlines = {}
+            self.channels = {}
+        
+        def _live(self, name):
+            deadline = self.deadlines.get(name)
+            if deadline is not None and deadline <= time.monotonic():
+                self.values.pop(name, None)
+                self.deadlines.pop(name, None)
+            return name in self.values
+        
+        async def set(self, name, value, nx=False, ex=None, px=None):
+            if nx and self._live(name):
+                return None
+            self.values[name] = value
+            self.deadlines.pop(name, None)
+            if ex is not None:
+                self.deadlines[name] = time.monotonic() + ex
+            if px is not None:
+                self.deadlines[name] = time.monotonic() + px / 1000
+            return True
+        
+        async def get(self, name):
+            return self.values[name] if self._live(name) else None
+        
+        async def ttl(self, name):
+            return self.deadlines[name] - time.monotonic()
+        
+        async def delete(self, name):
+            self.values.pop(name, None)
+            self.deadlines.pop(name, None)
+        
+        async def eval(self, script, numkeys, *args):
+            # Runs the store's two scripts: act only if the token matches
+            (name, channel), (token, *rest) = args[:numkeys], args[numkeys:]
+            value = await self.get(name)
+            if value is None or value[:16] != token:
+                return 0
+            if script == RedisIdempotencyStore._put_script:
+                await self.set(name, rest[0], ex=rest[1])
+            elif value[32] == Status.PROCESSING:
+                await self.delete(name)
+            else:
+                return 0
+            await self.publish(channel, b"")
+            return 1
+        
+        async def publish(self, channel, message):
+            for queue in self.channels.get(channel, []):
+                queue.put_nowait({"type": "message", "data": message})
+        
+        def pubsub(self):
+            fake = self
+            queue = asyncio.Queue()
+            subscribed = []
+            
+            class PubSub:
+                async def subscribe(self, channel):
+                    fake.channels.setdefault(channel, []).append(queue)
+                    subscribed.append(channel)
+                
+                async def get_message(self, ignore_subscribe_messages=False, timeout=None):
+                    try:
+                        return await asyncio.wait_for(queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        return None
+                
+                async def unsubscribe(self):
+                    for channel in subscribed:
+                        fake.channels[channel].remove(queue)
+                
+                async def aclose(self):
+                    pass
+            
+            return PubSub()
+    
+    def test_redis_store():
+        """Test claiming, waiting on and completing keys in the Redis store"""
+        fingerprint = request_fingerprint("POST", "/payments", b'{"amount": 100.0}')
+        token1, token2 = uuid.uuid4().bytes, uuid.uuid4().bytes
+        completed = StoreEntry(
+            fingerprint=fingerprint,
+            token=token1,
+            status=Status.COMPLETED,
+            status_code=200,
+            response_body=b'{}'
+        )
+        
+        async def run():
+            client = FakeRedis()
+            worker1 = RedisIdempotencyStore(client, lease_time=0.2, wait_timeout=1.0)
+            worker2 = RedisIdempotencyStore(client, lease_time=0.2, wait_timeout=1.0)
+            
+            # Only one worker claims a key, with the short lease
+            assert await worker1.acquire_lease("a", fingerprint, token1) is None
+            entry = await worker2.acquire_lease("a", fingerprint, token2)
+            assert entry.status is Status.PROCESSING
+            assert await client.ttl("idempotency:a") <= 0.2
+            
+            # A waiting worker is woken once the response is stored, and
+            # the key then lives for the full expiry
+            async def complete():
+                await asyncio.sleep(0.05)
+                await worker1.put("a", completed)
+            
+            entry, _ = await asyncio.gather(worker2.wait("a"), complete())
+            assert entry == completed
+            assert await client.ttl("idempotency:a") > 60 * 60
+            
+            # A key whose worker crashed frees up once the lease runs out
+            assert await worker1.acquire_lease("b", fingerprint, token1) is None
+            assert await worker2.wait("b") is None
+            assert await worker2.acquire_lease("b", fingerprint, token2) is None
+            
+            # The crashed worker coming back can't release or complete the
+            # key the other worker claimed since
+            await worker1.release("b", token1)
+            assert (await worker2.get("b")).token == token2
+            await worker1.put("b", completed)
+            assert (await worker2.get("b")).status is Status.PROCESSING
+            
+            # A released key wakes its waiters and can be claimed again
+            async def release():
+                await asyncio.sleep(0.05)
+                await worker2.release("b", token2)
+            
+            entry, _ = await asyncio.gather(worker1.wait("b"), release())
+            assert entry is None
+            assert await worker1.acquire_lease("b", fingerprint, token1) is None
+        
+        asyncio.run(run())
     
     # Run all tests
     test_successful_payment()
@@ -320,10 +1162,34 @@ if __name__ == "__main__":
     test_concurrent_requests()
     print("✓ Test concurrent requests passed")
     
+    test_cancelled_request()
+    print("✓ Test cancelled request passed")
+    
+    test_failed_request_releases_key()
+    print("✓ Test failed request releases key passed")
+    
+    test_unrouted_request_releases_key()
+    print("✓ Test unrouted request releases key passed")
+    
     test_missing_idempotency_key()
     print("✓ Test missing idempotency key passed")
     
+    test_non_json_content_type()
+    print("✓ Test non-JSON content type passed")
+    
+    test_openapi_schema()
+    print("✓ Test OpenAPI schema passed")
+    
     test_key_expiration()
     print("✓ Test key expiration passed")
     
+    test_max_entries()
+    print("✓ Test max entries passed")
+    
+    test_redis_entry_round_trip()
+    print("✓ Test Redis entry round trip passed")
+    
+    test_redis_store()
+    print("✓ Test Redis store passed")
+    
     print("\nAll tests passed! 🎉")
\ No newline at end of file